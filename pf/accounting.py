@@ -18,12 +18,123 @@ credits    :
 
 """
 import datetime
+import itertools
 import numpy as np
 import pandas as pd
 
-from pf.constants import DAYS_IN_YEAR
+try:
+    import numba
+except ImportError:
+    numba = None
+
+from pf.constants import DAYS_IN_YEAR, FI_MULTIPLIER
 from pf.util import get_age
 
+################################################################################################################################
+# Financial Statement Helpers
+################################################################################################################################
+def _encode_labels(labels=None, category_dict=None):
+    """
+    Encode the `labels` sets of each transaction as compressed sparse rows of integer codes for the labels used in
+    `category_dict`, returns the row pointers, the label codes and a dictionary mapping each label to its code.
+    """
+
+    # Collect all the labels used by the categories
+    all_labels = sorted({
+        label
+        for v0 in category_dict.values()
+        for v1 in v0.values()
+        for v2 in v1.values()
+        for label in v2.get('labels', set())
+    })
+    label_index = {label: i for i, label in enumerate(all_labels)}
+
+    # Code each transaction's labels in one pass, row i's codes are label_codes[label_indptr[i]:label_indptr[i + 1]]
+    row_codes = [[label_index[label] for label in row_labels if label in label_index] for row_labels in labels]
+    label_indptr = np.zeros(len(row_codes) + 1, dtype=np.intp)
+    np.cumsum([len(codes) for codes in row_codes], out=label_indptr[1:])
+    label_codes = np.fromiter(itertools.chain.from_iterable(row_codes), dtype=np.intp, count=label_indptr[-1])
+
+    return label_indptr, label_codes, label_index
+
+if numba is not None:
+    @numba.njit(parallel=True, cache=True)
+    def _has_label_kernel(label_indptr, label_codes, query, out):
+        """Compiled row loop of `_has_label`, marks `out` for each row with any label code selected by `query`."""
+        #pylint: disable=not-an-iterable
+        for i in numba.prange(len(out)):
+            hit = False
+            for j in range(label_indptr[i], label_indptr[i + 1]):
+                if query[label_codes[j]]:
+                    hit = True
+                    break
+            out[i] = hit
+
+def _has_label(label_indptr=None, label_codes=None, query=None):
+    """
+    Return a boolean mask of the transactions encoded by `_encode_labels` with any label selected by the boolean `query`
+    lookup, uses a compiled kernel when numba is installed.
+    """
+    if numba is not None:
+        out = np.empty(len(label_indptr) - 1, dtype=bool)
+        _has_label_kernel(label_indptr, label_codes, query, out)
+        return out
+
+    # Reduce the label hits of each row, rows without labels would pick up the next row's first hit so mask them out
+    hits = np.append(query[label_codes], False)
+    return np.logical_or.reduceat(hits, label_indptr[:-1]) & (np.diff(label_indptr) > 0)
+
+def _factorize(values=None):
+    """
+    Encode `values` as categorical integer codes, returns the codes and a dictionary mapping each category to its code.
+    Values that are already categorical are not hashed again.
+    """
+    categorical = values.astype('category')
+    return categorical.cat.codes.values, {value: i for i, value in enumerate(categorical.cat.categories)}
+
+def _lookup(code_index=None, values=None):
+    """
+    Return a boolean lookup table of the codes of `values` from the `code_index` mapping, the extra last entry keeps missing
+    values (code -1) unselected.
+    """
+    lookup = np.zeros(len(code_index) + 1, dtype=bool)
+    lookup[[code_index[value] for value in values if value in code_index]] = True
+    return lookup
+
+def _isin_codes(codes=None, code_index=None, values=None):
+    """Return a boolean mask of the factorized `codes` whose value is in `values`, an `isin` on integers instead of objects."""
+    return _lookup(code_index, values)[codes]
+
+def _day_numbers(index=None, dates=None):
+    """
+    Number each entry of the DatetimeIndex `index` by its day within the daily `dates`, entries outside of `dates` are numbered
+    `len(dates)` so `_daily_sum` can drop them.
+    """
+    days = np.asarray((index.normalize() - dates[0].normalize()).days)
+    return np.where((days >= 0) & (days < len(dates)), days, len(dates))
+
+def _daily_sum(days=None, amounts=None, num_days=None):
+    """Sum `amounts` by their day numbers `days` with a single `np.bincount`, returns an array of `num_days` daily sums."""
+    return np.bincount(days, weights=amounts, minlength=num_days + 1)[:num_days]
+
+def _category_items(category_dict=None, defaults=None):
+    """
+    Flatten the 3 level `category_dict`, via 3 level list comprehension, returns a list of ((k0, k1, k2), v2) items sorted by
+    category so it can be built once into output columns.  If `defaults` is given, each v2 dictionary is returned as a copy
+    merged over the `defaults` dictionary, leaving `category_dict` untouched.
+    """
+    items = sorted([
+        ((k0, k1, k2), v2)
+        for k0, v0 in category_dict.items()
+        for k1, v1 in v0.items()
+        for k2, v2 in v1.items()
+    ], key=lambda item: item[0])
+
+    if defaults is not None:
+        items = [(cat, dict(defaults, **v2)) for cat, v2 in items]
+
+    return items
+
 ################################################################################################################################
 # Financial Statements
 ################################################################################################################################
@@ -69,18 +180,28 @@ def calc_balance(accounts=None, category_dict=None):
     }
     """
 
-    # Aggregate accounts based on category definition, via 3 level dictionary comprehension
-    balance_dict = {
-        (k0, k1, k2): accounts[v2].sum(axis=1) if v2 else pd.Series(0, index=accounts.index)
-        for k0, v0 in category_dict.iteritems()
-        for k1, v1 in v0.iteritems()
-        for k2, v2 in v1.iteritems()
-    }
+    # Flatten category definition
+    cats = _category_items(category_dict)
 
-    # Convert to DataFrame
-    balance = pd.DataFrame(balance_dict)
+    # Build indicator matrix of the account columns in each category, selecting positions the same way as `accounts[v2]`
+    positions = pd.DataFrame([np.arange(len(accounts.columns))], columns=accounts.columns)
+    indicator = np.zeros((len(accounts.columns), len(cats)))
+    for i, (_, v2) in enumerate(cats):
+        if v2:
+            np.add.at(indicator[:, i], positions[v2].values.ravel(), 1.0)
+
+    # Aggregate accounts of all categories at once, masking out non-finite values since `inf * 0` would reach every category
+    values = accounts.fillna(0.0).values
+    finite = np.isfinite(values)
+    sums = np.dot(np.where(finite, values, 0.0), indicator)
 
-    return balance.fillna(0.0)
+    # Sum categories with non-finite accounts directly, so those values only reach their own categories
+    for i in np.flatnonzero(indicator[~finite.all(axis=0)].any(axis=0)):
+        sums[:, i] = accounts[cats[i][1]].sum(axis=1).fillna(0.0).values
+
+    balance = pd.DataFrame(sums, index=accounts.index, columns=pd.MultiIndex.from_tuples([cat for cat, _ in cats]))
+
+    return balance
 
 def balance_sheet(balance=None, period=datetime.datetime.now().year):
     """
@@ -101,15 +222,11 @@ def balance_sheet(balance=None, period=datetime.datetime.now().year):
     ```
     """
 
-    # Force to list, so code below is the same for all cases
-    if not isinstance(period, list):
-        period = [period]
+    # Force to list of strings, so code below is the same for all cases
+    period = [str(p) for p in (period if isinstance(period, list) else [period])]
 
     balance_sheets = []
     for p in period:
-        # Force period to string
-        p = str(p)
-
         # Sum over Period and convert to Statement DataFrame
         p_balance = pd.DataFrame(balance[p].iloc[-1])
         p_balance.columns = ['$']
@@ -124,20 +241,20 @@ def balance_sheet(balance=None, period=datetime.datetime.now().year):
         balance_df = pd.concat([p_balance, net])
 
         # Calculate percentages of level 0
-        balance_df['%'] = 100.0 * balance_df.div(balance_df.sum(level=0), level=0)
+        balance_df['%'] = 100.0 * balance_df['$'].div(balance_df['$'].sum(level=0), level=0)
 
-        # Calculate heirarchical totals
+        # Calculate heirarchical totals, level 0 totals are reduced from the level 1 totals
         l1_totals = balance_df.sum(level=[0, 1])
+        l0_totals = l1_totals.sum(level=[0])
+
         l1_totals.index = pd.MultiIndex.from_tuples([(x0, x1, 'Total') for x0, x1 in l1_totals.index])
         l1_totals.index.names = ['Category', 'Type', 'Item']
 
-        l0_totals = balance_df.sum(level=[0])
         l0_totals.index = pd.MultiIndex.from_tuples([(x0, 'Total', ' ') for x0 in l0_totals.index])
         l0_totals.index.names = ['Category', 'Type', 'Item']
 
-        # Add totals to dataframe
-        balance_df = balance_df.combine_first(l1_totals)
-        balance_df = balance_df.combine_first(l0_totals)
+        # Add totals to dataframe, keeping the first non-null value of any existing row (e.g. Net totals)
+        balance_df = pd.concat([balance_df, l1_totals, l0_totals]).groupby(level=[0, 1, 2]).first()
 
         # Update columns with period
         balance_df.columns = pd.MultiIndex.from_product([[p], balance_df.columns])
@@ -209,58 +326,42 @@ def calc_income(paychecks=None, transactions=None, category_dict=None, tax_type=
     ```
     """
 
-    # Clean category
-    for k0, v0 in category_dict.iteritems():
-        for k1, v1 in v0.iteritems():
-            for k2, v2 in v1.iteritems():
-                if not v2.has_key('source'):
-                    category_dict[k0][k1][k2]['source'] = 'transactions'
-                if not v2.has_key('labels'):
-                    category_dict[k0][k1][k2]['labels'] = set()
-                if not v2.has_key('logic'):
-                    category_dict[k0][k1][k2]['logic'] = ''
-                if not v2.has_key('agg'):
-                    category_dict[k0][k1][k2]['agg'] = np.ones(len(category_dict[k0][k1][k2]['categories']))
-                if not v2.has_key('tax_type'):
-                    category_dict[k0][k1][k2]['tax_type'] = 'realized'
-
-    # Aggregate accounts based on category definition, via 3 level dictionary comprehension
-    income_dict = {}
-    for k0, v0 in category_dict.iteritems():
-        for k1, v1 in v0.iteritems():
-            for k2, v2 in v1.iteritems():
-
-                if v2['source'] == 'transactions':
-                    income_dict[(k0, k1, k2)] = transactions[
-                        (
-                            # If it is in the category
-                            transactions['Category'].isin(v2['categories'])
-                            & transactions['Account Name'].isin(tax_type[v2['tax_type']])
-                        ) & (
-                            # And if is has the correct label
-                            (transactions['Labels'].apply(
-                                lambda x: x.isdisjoint(v2['labels']) if v2['logic'] else not x.isdisjoint(v2['labels'])
-                            )) |
-                            # Or it does not have any labels
-                            (transactions['Labels'].apply(lambda x: v2['labels'] == set()))
-                        )
-                    ]['Amount']
-                else:
-                    income_dict[(k0, k1, k2)] = (v2['agg'] * paychecks[list(v2['categories'])]).sum(axis=1)
+    # Flatten category definition, filling in the default optional keys of each category
+    cats = _category_items(category_dict, defaults={
+        'source': 'transactions', 'labels': set(), 'logic': '', 'agg': 1.0, 'tax_type': 'realized'
+    })
 
-    # Convert to DataFrame
-    cats = income_dict.keys()
-    cats.sort()
-    income = pd.DataFrame(
-        data=[],
-        columns=pd.MultiIndex.from_tuples(cats),
-        index=pd.date_range(transactions.index[-1], transactions.index[0])
-    )
-    for cat in income_dict:
-        cat_df = pd.DataFrame(income_dict[cat].values, index=income_dict[cat].index, columns=pd.MultiIndex.from_tuples([cat]))
-        income[cat] = cat_df.groupby(lambda x: x.date()).sum()
+    # Number transactions by day and encode their amounts, categories, accounts and labels once for all categories
+    dates = pd.date_range(transactions.index[-1], transactions.index[0])
+    days = _day_numbers(transactions.index, dates)
+    amounts = transactions['Amount'].fillna(0.0).values
+    category_codes, category_index = _factorize(transactions['Category'])
+    account_codes, account_index = _factorize(transactions['Account Name'])
+    label_indptr, label_codes, label_index = _encode_labels(transactions['Labels'], category_dict)
+
+    # Aggregate accounts based on category definition, one column of daily sums per category
+    income = np.zeros((len(dates), len(cats)))
+    for i, (_, v2) in enumerate(cats):
+
+        if v2['source'] == 'transactions':
+            # If it is in the category
+            selected = (
+                _isin_codes(category_codes, category_index, v2['categories'])
+                & _isin_codes(account_codes, account_index, tax_type[v2['tax_type']])
+            )
+            # And if is has the correct label, a category without labels does not filter on labels at all
+            if v2['labels']:
+                has_label = _has_label(label_indptr, label_codes, _lookup(label_index, v2['labels']))
+                selected &= ~has_label if v2['logic'] else has_label
+            income[:, i] = _daily_sum(days[selected], amounts[selected], len(dates))
+        else:
+            paycheck = (v2['agg'] * paychecks[list(v2['categories'])]).sum(axis=1)
+            income[:, i] = _daily_sum(_day_numbers(paycheck.index, dates), paycheck.values, len(dates))
 
-    return income.fillna(0.0)
+    # Convert to DataFrame, building the MultiIndex columns once
+    income = pd.DataFrame(income, index=dates, columns=pd.MultiIndex.from_tuples([cat for cat, _ in cats]))
+
+    return income
 
 def income_statement(income=None, period=datetime.datetime.now().year, nettax=None):
     """
@@ -277,46 +378,42 @@ def income_statement(income=None, period=datetime.datetime.now().year, nettax=No
     ```
     """
 
-    # Force to list, so code below is the same for all cases
-    if not isinstance(period, list):
-        period = [period]
+    # Force to list of strings, so code below is the same for all cases
+    period = [str(p) for p in (period if isinstance(period, list) else [period])]
+
+    # Set default nettax
+    nettax = nettax if nettax else {'Taxes'}
 
     income_statements = []
     for p in period:
-        # Force period to string and set default nettax
-        p = str(p)
-        nettax = nettax if nettax else {'Taxes'}
-
         # Convert to DataFrame
         p_income = pd.DataFrame(income[p].sum(), columns=['$'])
         p_income.index.names = ['Category', 'Type', 'Item']
 
         # Calculate percentages of level 0
-        p_income['%'] = 100.0 * p_income.div(p_income.sum(level=0), level=0)
+        p_income['%'] = 100.0 * p_income['$'].div(p_income['$'].sum(level=0), level=0)
 
-        # Calculate heirarchical totals
+        # Calculate heirarchical totals, level 0 totals are reduced from the level 1 totals
         l1_totals = p_income.sum(level=[0, 1])
+        l0_totals = l1_totals.sum(level=[0])
+
         l1_totals.index = pd.MultiIndex.from_tuples([(x0, x1, 'Total') for x0, x1 in l1_totals.index])
         l1_totals.index.names = ['Category', 'Type', 'Item']
 
-        l0_totals = p_income.sum(level=[0])
         l0_totals.index = pd.MultiIndex.from_tuples([(x0, 'Total', ' ') for x0 in l0_totals.index])
         l0_totals.index.names = ['Category', 'Type', 'Item']
 
-        # Add totals to dataframe
-        p_income = p_income.combine_first(l1_totals)
-        p_income = p_income.combine_first(l0_totals)
+        # Add totals to dataframe, keeping the first non-null value of any existing row (e.g. Net totals)
+        p_income = pd.concat([p_income, l1_totals, l0_totals]).groupby(level=[0, 1, 2]).first()
 
-        # Calculate Net
-        before = [(x, 'Total', ' ') for x in set(p_income.index.levels[0]).difference(nettax)]
-        after = [(x, 'Total', ' ') for x in set(p_income.index.levels[0])]
+        # Calculate Net from the level 0 totals
+        l0_dollars = l0_totals['$']
+        is_tax = l0_dollars.index.get_level_values(0).isin(nettax)
+        before_taxes = l0_dollars.values[~is_tax].sum()
+        after_taxes = l0_dollars.values.sum()
 
         net = pd.DataFrame({
-            '$': [
-                p_income.loc[before]['$'].sum(),
-                p_income.loc[after]['$'].sum(),
-                p_income.loc[after]['$'].sum()
-            ]
+            '$': [before_taxes, after_taxes, after_taxes]
         }, index=pd.MultiIndex.from_tuples([
             ('Net', 'Net Income', 'Before Taxes'),
             ('Net', 'Net Income', 'After Taxes'),
@@ -389,51 +486,35 @@ def calc_cashflow(transactions=None, category_dict=None, tax_type=None):
     ```
     """
 
-    # Add empty 'labels' key to dictionary if they do not have the item
-    # Add default 'logic' if it does not exist
-    for k0, v0 in category_dict.iteritems():
-        for k1, v1 in v0.iteritems():
-            for k2, v2 in v1.iteritems():
-                if not v2.has_key('labels'):
-                    category_dict[k0][k1][k2]['labels'] = set()
-                if not v2.has_key('logic'):
-                    category_dict[k0][k1][k2]['logic'] = ''
-                if not v2.has_key('tax_type'):
-                    category_dict[k0][k1][k2]['tax_type'] = 'realized'
-
-    # Aggregate transactions based on category definition, via 3 level dictionary comprehension
-    #pylint: disable=cell-var-from-loop
-    cashflow_dict = {
-        (k0, k1, k2): transactions[
-            # If it is in the category & in the tax type
-            (transactions['Category'].isin(v2['categories']) & transactions['Account Name'].isin(tax_type[v2['tax_type']])) &
-            (
-                # And if is has the correct label
-                (transactions['Labels'].apply(
-                    lambda x: x.isdisjoint(v2['labels']) if v2['logic'] else not x.isdisjoint(v2['labels'])
-                )) |
-                # Or it does not have any labels
-                (transactions['Labels'].apply(lambda x: v2['labels'] == set()))
-            )
-        ]['Amount']
-        for k0, v0 in category_dict.iteritems()
-        for k1, v1 in v0.iteritems()
-        for k2, v2 in v1.iteritems()
-    }
-
-    # Convert to DataFrame
-    cols = cashflow_dict.keys()
-    cols.sort()
-    cashflow = pd.DataFrame(
-        data=[],
-        columns=pd.MultiIndex.from_tuples(cols),
-        index=pd.date_range(transactions.index[-1], transactions.index[0])
-    )
-    for cat in cashflow_dict:
-        c = pd.DataFrame(cashflow_dict[cat].values, index=cashflow_dict[cat].index, columns=pd.MultiIndex.from_tuples([cat]))
-        cashflow[cat] = c.groupby(lambda x: x.date()).sum()
-
-    return cashflow.fillna(0.0)
+    # Flatten category definition, filling in the default optional keys of each category
+    cats = _category_items(category_dict, defaults={'labels': set(), 'logic': '', 'tax_type': 'realized'})
+
+    # Number transactions by day and encode their amounts, categories, accounts and labels once for all categories
+    dates = pd.date_range(transactions.index[-1], transactions.index[0])
+    days = _day_numbers(transactions.index, dates)
+    amounts = transactions['Amount'].fillna(0.0).values
+    category_codes, category_index = _factorize(transactions['Category'])
+    account_codes, account_index = _factorize(transactions['Account Name'])
+    label_indptr, label_codes, label_index = _encode_labels(transactions['Labels'], category_dict)
+
+    # Aggregate transactions based on category definition, one column of daily sums per category
+    cashflow = np.zeros((len(dates), len(cats)))
+    for i, (_, v2) in enumerate(cats):
+        # If it is in the category & in the tax type
+        selected = (
+            _isin_codes(category_codes, category_index, v2['categories'])
+            & _isin_codes(account_codes, account_index, tax_type[v2['tax_type']])
+        )
+        # And if is has the correct label, a category without labels does not filter on labels at all
+        if v2['labels']:
+            has_label = _has_label(label_indptr, label_codes, _lookup(label_index, v2['labels']))
+            selected &= ~has_label if v2['logic'] else has_label
+        cashflow[:, i] = _daily_sum(days[selected], amounts[selected], len(dates))
+
+    # Convert to DataFrame, building the MultiIndex columns once
+    cashflow = pd.DataFrame(cashflow, index=dates, columns=pd.MultiIndex.from_tuples([cat for cat, _ in cats]))
+
+    return cashflow
 
 def cashflow_statement(cashflow=None, period=datetime.datetime.now().year):
     """
@@ -450,15 +531,11 @@ def cashflow_statement(cashflow=None, period=datetime.datetime.now().year):
     ```
     """
 
-    # Force to list, so code below is the same for all cases
-    if not isinstance(period, list):
-        period = [period]
+    # Force to list of strings, so code below is the same for all cases
+    period = [str(p) for p in (period if isinstance(period, list) else [period])]
 
     cashflow_statements = []
     for p in period:
-        # Force period to string
-        p = str(p)
-
         # Sum over Period and convert to Statement DataFrame
         p_cashflow = pd.DataFrame(cashflow[p].sum(), columns=['$'])
         p_cashflow.index.names = ['Category', 'Type', 'Item']
@@ -472,20 +549,20 @@ def cashflow_statement(cashflow=None, period=datetime.datetime.now().year):
         cashflow_df = pd.concat([p_cashflow, net])
 
         # Calculate percentages of level 0
-        cashflow_df['%'] = 100.0 * cashflow_df.div(cashflow_df.sum(level=0), level=0)
+        cashflow_df['%'] = 100.0 * cashflow_df['$'].div(cashflow_df['$'].sum(level=0), level=0)
 
-        # Calculate heirarchical totals
+        # Calculate heirarchical totals, level 0 totals are reduced from the level 1 totals
         l1_totals = cashflow_df.sum(level=[0, 1])
+        l0_totals = l1_totals.sum(level=[0])
+
         l1_totals.index = pd.MultiIndex.from_tuples([(x0, x1, 'Total') for x0, x1 in l1_totals.index])
         l1_totals.index.names = ['Category', 'Type', 'Item']
 
-        l0_totals = cashflow_df.sum(level=[0])
         l0_totals.index = pd.MultiIndex.from_tuples([(x0, 'Total', ' ') for x0 in l0_totals.index])
         l0_totals.index.names = ['Category', 'Type', 'Item']
 
-        # Add totals to dataframe
-        cashflow_df = cashflow_df.combine_first(l1_totals)
-        cashflow_df = cashflow_df.combine_first(l0_totals)
+        # Add totals to dataframe, keeping the first non-null value of any existing row (e.g. Net totals)
+        cashflow_df = pd.concat([cashflow_df, l1_totals, l0_totals]).groupby(level=[0, 1, 2]).first()
 
         # Update columns with period
         cashflow_df.columns = pd.MultiIndex.from_product([[p], cashflow_df.columns])
@@ -498,28 +575,132 @@ def cashflow_statement(cashflow=None, period=datetime.datetime.now().year):
 
     return cashflow_statement_df
 
+################################################################################################################################
+# Metric Helpers
+################################################################################################################################
+# Labels of the rows of `_tax_ratios` and of all `calc_metrics` columns, built once
+_RATIO_LABELS = (
+    'Total Income Tax Rate [%]', 'Realized Income Tax Rate [%]', 'Income Tax to Net [%]', 'Income Tax to Expense [%]',
+    'Total Sales Tax Rate [%]', 'Realized Sales Tax Rate [%]', 'Sales Tax to Net [%]', 'Sales Tax to Expense [%]',
+    'Total Tax Rate [%]', 'Realized Total Tax Rate [%]', 'Total Tax to Net [%]', 'Total Tax to Expense [%]',
+    'FI Amount [$]', 'FI Shortfall [$]', 'FI Percent [%]'
+)
+_METRIC_LABELS = (
+    'Debt Ratio [%]', 'Debt to Income [%]', 'Debt Utilization [%]',
+    'Income Net Multiple [Yr]', 'Expense Net Multiple [Yr]',
+    'Profit Margin [%]',
+    'SWR Expense Covered [%]', 'SWR Income Covered [%]',
+    'Realized Income to Net [%]'
+) + _RATIO_LABELS
+_METRIC_INDEX = pd.Index(_METRIC_LABELS)
+
+# Rows per tile of the numpy ratio computation
+_METRIC_TILE = 4096
+
+def _metric_output(metrics=None, index=None, as_frame=True):
+    """Wrap the (metric, row) `metrics` array as a DataFrame over `index`, or as records with a field per metric."""
+    if as_frame:
+        return pd.DataFrame(metrics.T, columns=_METRIC_INDEX, index=index, copy=False)
+    records = np.empty(metrics.shape[1], dtype=[(label, metrics.dtype) for label in _METRIC_LABELS])
+    for label, values in zip(_METRIC_LABELS, metrics):
+        records[label] = values
+    return records
+
+def _divide(numerator=None, denominator=None):
+    """Divide `numerator` by the `denominator` array, zero denominators give NaN instead of inf."""
+    return np.divide(numerator, denominator, out=np.full_like(denominator, np.nan), where=denominator != 0.0)
+
+if numba is not None:
+    @numba.njit(parallel=True, cache=True, error_model='numpy', fastmath={'arcp', 'contract'})
+    def _tax_ratio_kernel(taxes, sales_tax, total_income, realized, net, expense, out):
+        """Compiled row loop of `_tax_ratios`, fills `out` with one ratio per row and one summary entry per column."""
+        #pylint: disable=not-an-iterable
+        for i in numba.prange(len(taxes)):
+            # Divide once per base, zero bases give NaN like `_divide`
+            inv_bases = (
+                1.0 / total_income[i] if total_income[i] != 0.0 else np.nan,
+                1.0 / realized[i] if realized[i] != 0.0 else np.nan,
+                1.0 / net[i] if net[i] != 0.0 else np.nan,
+                1.0 / -expense[i] if expense[i] != 0.0 else np.nan
+            )
+            tax_numerators = (-100.0 * taxes[i], -100.0 * sales_tax[i], -100.0 * (taxes[i] + sales_tax[i]))
+            for j in range(3):
+                for k in range(4):
+                    out[4 * j + k, i] = tax_numerators[j] * inv_bases[k]
+
+            fi_amount = FI_MULTIPLIER * -expense[i]
+            out[12, i] = fi_amount
+            out[13, i] = fi_amount - net[i]
+            out[14, i] = 100.0 * net[i] / fi_amount if fi_amount != 0.0 else np.nan
+
+def _tax_ratio_tile(taxes=None, sales_tax=None, total_income=None, realized=None, net=None, expense=None, out=None):
+    """Numpy version of `_tax_ratio_kernel` for one tile of rows, writes each ratio straight into `out`."""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Divide once per base, then scale the reciprocals by each tax numerator
+        inv_bases = _divide(1.0, np.stack([total_income, realized, net, -expense]))
+        for i, tax in enumerate((taxes, sales_tax, taxes + sales_tax)):
+            np.multiply(-100.0 * tax, inv_bases, out=out[4 * i:4 * i + 4])
+
+        fi_amount = np.multiply(FI_MULTIPLIER, -expense, out=out[12])
+        np.subtract(fi_amount, net, out=out[13])
+        out[14] = _divide(100.0 * net, fi_amount)
+
+def _tax_ratios(taxes=None, sales_tax=None, total_income=None, realized=None, net=None, expense=None, out=None):
+    """
+    Calculate the tax ratios of each tax (income, sales, total) to each base (total income, realized income, net, expense)
+    followed by the FI amount, shortfall and percent, returns a (15, N) array written into `out` if given.  Uses a compiled
+    kernel when numba is installed.
+    """
+    if out is None:
+        out = np.empty((len(_RATIO_LABELS), len(taxes)))
+
+    if numba is not None:
+        _tax_ratio_kernel(taxes, sales_tax, total_income, realized, net, expense, out)
+        return out
+
+    # Work through tiles of rows so the inputs stay in cache while every ratio of the tile is written
+    for start in range(0, len(taxes), _METRIC_TILE):
+        tile = slice(start, start + _METRIC_TILE)
+        _tax_ratio_tile(
+            taxes[tile], sales_tax[tile], total_income[tile], realized[tile], net[tile], expense[tile], out[:, tile]
+        )
+
+    return out
+
 ################################################################################################################################
 # Net Worth Calculations
 ################################################################################################################################
 def calculate_net_worth(accounts=None):
     """Calculate Net Worth (Assets - Debts) based on `accounts` DataFrame"""
 
-    # Aggregate accounts by assets and debts
-    net_worth = pd.DataFrame({
-        'Assets': accounts[accounts > 0.0].fillna(0.0).sum(1),
-        'Debts': accounts[accounts < 0.0].fillna(0.0).sum(1),
-    })
+    # Aggregate accounts by assets and debts, NaNs are never selected
+    values = accounts.values
+    assets = np.where(values > 0.0, values, 0.0).sum(axis=1)
+    debts = np.where(values < 0.0, values, 0.0).sum(axis=1)
 
     # Calculate Net Worth
-    net_worth['Net'] = net_worth['Assets'] + net_worth['Debts']
+    net_worth = pd.DataFrame(
+        {'Assets': assets, 'Debts': debts, 'Net': assets + debts},
+        index=accounts.index,
+        columns=['Assets', 'Debts', 'Net']
+    )
 
     # Calculate Debt Ratio
     net_worth['Debt Ratio'] = 100.0 * (net_worth['Debts'].abs() / net_worth['Assets'])
 
-    # Calculate Dollar and Percent Change
-    for x in ['Assets', 'Debts', 'Net']:
-        net_worth['{} Change ($)'.format(x)] = net_worth[x].diff(1).fillna(0.0)
-        net_worth['{} Change (%)'.format(x)] = 100.0 * net_worth[x].pct_change().fillna(0.0)
+    # Calculate Dollar and Percent Change of all columns at once, first entry and 0/0 change are zero
+    columns = ['Assets', 'Debts', 'Net']
+    values = net_worth[columns].values
+    delta = np.zeros_like(values)
+    delta[1:] = values[1:] - values[:-1]
+    percent = np.zeros_like(values)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        percent[1:] = 100.0 * delta[1:] / values[:-1]
+    percent[np.isnan(percent)] = 0.0
+
+    for i, x in enumerate(columns):
+        net_worth['{} Change ($)'.format(x)] = delta[:, i]
+        net_worth['{} Change (%)'.format(x)] = percent[:, i]
 
     return net_worth
 
@@ -527,15 +708,18 @@ def calculate_stats(net_worth=None):
     """Calculate the statistics (Current, Max, Min, Mean, Median, Std. Dev.) of a `net_worth` DataFrame"""
 
     # Remove Infs and NaNs
-    net_worth = net_worth.replace([-np.Inf, np.Inf, np.nan], 0.0)
-
-    # Calculate Statistics
-    stats = pd.DataFrame({'Current': net_worth.iloc[-1]})
-    stats['Max'] = net_worth.max(skipna=True)
-    stats['Min'] = net_worth.min(skipna=True)
-    stats['Mean'] = net_worth.mean(skipna=True)
-    stats['Median'] = net_worth.median(skipna=True)
-    stats['Std Dev'] = net_worth.std(skipna=True)
+    values = net_worth.values.astype(float)
+    values = np.where(np.isfinite(values), values, 0.0)
+
+    # Calculate Statistics, all from the same cleaned array
+    stats = pd.DataFrame({
+        'Current': values[-1],
+        'Max': values.max(axis=0),
+        'Min': values.min(axis=0),
+        'Mean': values.mean(axis=0),
+        'Median': np.median(values, axis=0),
+        'Std Dev': values.std(axis=0, ddof=1)
+    }, index=net_worth.columns, columns=['Current', 'Max', 'Min', 'Mean', 'Median', 'Std Dev'])
 
     return stats
 
@@ -580,44 +764,50 @@ def calculate_growth(net_worth=None, offsets=None):
         ('Life', (pd.DateOffset(days=-(net_worth.index[-1] - net_worth.index[0]).days),))
     ]
 
-    growth = []
+    # Compute initial dates of the periods inside data
+    periods = []
     for offstr, offset in offsets:
-        # Compute offset date
-        final = current_index
         initial = current_index
         for t in offset:
             initial = initial + t
-
-        # If inside data
         if initial >= net_worth.index[0]:
-            # Set time indexes
-            initial_date = initial.date().strftime('%b %Y')
-            final_date = final.date().strftime('%b %Y')
-            number_of_days = (final - initial).days
-            number_of_years = number_of_days / DAYS_IN_YEAR
-            # Calculate growth
-            delta = net_worth.loc[final][columns] - net_worth.loc[initial][columns]
-            gains = 100.0 * delta / net_worth.loc[initial][columns]
-            annualized_gains = gains / number_of_years
-            try:
-                cagr = 100.0 * (
-                    (net_worth.loc[final][columns] / net_worth.loc[initial][columns]).pow(1.0 / number_of_years) - 1.0
-                )
-            except ZeroDivisionError:
-                cagr = pd.Series(np.zeros(gains.shape))
-            # Store Info in Dictionary
-            #pylint: disable=maybe-no-member
-            growth.extend([
-                [offstr, final_date] + net_worth.loc[final][columns].round(2).values.tolist(),
-                [offstr, initial_date] + net_worth.loc[initial][columns].round(2).values.tolist(),
-                [offstr, 'Delta'] + delta.round(2).values.tolist(),
-                [offstr, 'Gain'] + gains.round(2).values.tolist(),
-                [offstr, 'Ann Gain'] + annualized_gains.round(2).values.tolist(),
-                [offstr, 'CAGR'] + cagr.round(2).values.tolist()
-            ])
+            periods.append((offstr, initial))
+
+    # Gather final and initial values of all periods at once
+    final = current_index
+    initials = [initial for _, initial in periods]
+    final_values = net_worth.loc[final, columns].values.astype(float)
+    initial_values = net_worth.loc[initials, columns].values.astype(float)
+    number_of_years = np.array([(final - initial).days for initial in initials], dtype=float) / DAYS_IN_YEAR
+
+    # Calculate growth of all periods at once, a zero length period has no CAGR
+    with np.errstate(divide='ignore', invalid='ignore'):
+        delta = final_values - initial_values
+        gains = 100.0 * delta / initial_values
+        annualized_gains = gains / number_of_years[:, np.newaxis]
+        cagr = 100.0 * (np.power(final_values / initial_values, 1.0 / number_of_years[:, np.newaxis]) - 1.0)
+    cagr[number_of_years == 0.0] = 0.0
+
+    # Stack six rows per period: final, initial, delta, gain, annualized gain and CAGR
+    growth = np.stack([
+        np.tile(final_values, (len(initials), 1)), initial_values, delta, gains, annualized_gains, cagr
+    ], axis=1).reshape(-1, len(columns))
+    final_date = final.date().strftime('%b %Y')
+    growth_labels = [
+        (offstr, growth_label)
+        for offstr, initial in periods
+        for growth_label in [final_date, initial.date().strftime('%b %Y'), 'Delta', 'Gain', 'Ann Gain', 'CAGR']
+    ]
 
     # Convert to DataFrame
-    growth_df = pd.DataFrame(growth, columns=['Period', 'Growth', 'Assets', 'Debts', 'Net']).set_index(['Period', 'Growth'])
+    growth_df = pd.DataFrame(
+        np.round(growth, 2),
+        index=pd.MultiIndex.from_arrays(
+            [[x0 for x0, _ in growth_labels], [x1 for _, x1 in growth_labels]],
+            names=['Period', 'Growth']
+        ),
+        columns=columns
+    )
 
     return growth_df
 
@@ -654,19 +844,24 @@ def get_milestones(networth=None, milestones=None):
     milestones = milestones if milestones else np.array([
         1e4, 2.5e4, 5e4, 7.5e4, 1e5, 1.5e5, 2e5, 2.5e5, 5e5, 7.5e5, 1e6, 1.5e6, 2e6
     ])
+
+    # Find the first time each milestone is reached, via binary search of the running maximum of net worth
+    net = networth['Net'].values
+    running_max = np.maximum.accumulate(np.where(np.isnan(net), -np.inf, net))
+    first_index = np.searchsorted(running_max, milestones, side='left')
+
     milestone_data = []
-    for milestone in milestones:
-        gt_milestone = networth['Net'] >= milestone
-        if gt_milestone.any():
-            milestone_date = gt_milestone[gt_milestone].index[0]
+    for milestone, i in zip(milestones, first_index):
+        if i < len(net):
+            milestone_date = networth.index[i]
             milestone_age = get_age(milestone_date)
             milestone_years = (milestone_date - datetime.datetime.today()).days / DAYS_IN_YEAR
-            milestone_actual = networth['Net'].loc[milestone_date]
+            milestone_actual = net[i]
         else:
             milestone_date = None
             milestone_age = None
             milestone_years = None
-            milestone_actual = -(milestone - networth['Net'].iloc[-1])
+            milestone_actual = -(milestone - net[-1])
 
         milestone_data.append((milestone_date, milestone, milestone_actual, milestone_age, milestone_years))
 
@@ -676,11 +871,17 @@ def summary_statement(networth=None, income=None, cashflow=None, limits=None, sa
     """
     Combine accounts, expenses, income, debt, etc. into one high level DataFrame
     """
+    # Sum cashflow and income by month once, everything below is sliced from these
+    monthly_cashflow = cashflow.resample('M').sum()
+    monthly_income = income.resample('M').sum()
+    monthly_outflow = monthly_cashflow['Outflow'].sum(axis=1)
+    monthly_investments = monthly_cashflow[('Outflow', 'Non-Operating', 'Purchased Investments')]
+
     # Estimate monthly sales tax spending
-    sales_tax_spending = cashflow[[
+    sales_tax_spending = monthly_cashflow[[
         ('Outflow', 'Non-Operating', 'Discretionary'),
         ('Outflow', 'Operating', 'Transportation')
-    ]].resample('M').sum().sum(axis=1)
+    ]].sum(axis=1)
     # Get tax rate average
     avg_sales_tax_percent = salestax.sum(1) / (salestax > 0).sum(1)
     # Calculate dollar amount of sales tax paid
@@ -688,25 +889,22 @@ def summary_statement(networth=None, income=None, cashflow=None, limits=None, sa
 
     summary = pd.concat([
         networth[['Assets', 'Debts', 'Net']],
-        12.0 * pd.DataFrame(income['Revenue'].resample('M').sum().sum(axis=1), columns=['Total Income']),
-        12.0 * pd.DataFrame(cashflow['Inflow'].resample('M').sum().sum(axis=1), columns=['Realized Income']),
+        12.0 * pd.DataFrame(monthly_income['Revenue'].sum(axis=1), columns=['Total Income']),
+        12.0 * pd.DataFrame(monthly_cashflow['Inflow'].sum(axis=1), columns=['Realized Income']),
+        12.0 * pd.DataFrame(monthly_outflow - monthly_investments, columns=['Expense + Loans']),
         12.0 * pd.DataFrame(
-            cashflow['Outflow'].resample('M').sum().sum(axis=1) \
-            - cashflow[('Outflow', 'Non-Operating', 'Purchased Investments')].resample('M').sum()
-            , columns=['Expense + Loans']),
-        12.0 * pd.DataFrame(
-            cashflow['Outflow'].resample('M').sum().sum(axis=1) \
-            - cashflow[('Outflow', 'Operating', 'Loan Payments')].resample('M').sum() \
-            - cashflow[('Outflow', 'Non-Operating', 'Purchased Investments')].resample('M').sum()
+            monthly_outflow \
+            - monthly_cashflow[('Outflow', 'Operating', 'Loan Payments')] \
+            - monthly_investments
             , columns=['Expense']),
-        12.0 * pd.DataFrame(income['Taxes'].resample('M').sum().sum(axis=1), columns=['Taxes']),
+        12.0 * pd.DataFrame(monthly_income['Taxes'].sum(axis=1), columns=['Taxes']),
         pd.DataFrame(limits.sum(axis=1), columns=['Credit Line']),
         12.0 * pd.DataFrame(sales_tax_pay, columns=['Sales Tax'])
     ], axis=1).dropna()
 
     return summary
 
-def calc_metrics(summary=None, swr=0.04):
+def calc_metrics(summary=None, swr=0.04, dtype=np.float64, as_frame=True):
     """
     Calculate various metrics for personal finance.
 
@@ -739,51 +937,53 @@ def calc_metrics(summary=None, swr=0.04):
     Total Tax to Net        = -(Taxes + Sales Tax) / Net
     Total Tax to Expense    = -(Taxes + Sales Tax) / -Expense
 
-    FI Amount = 25 * -Expense
-    FI Shortfall = Net - (25 * -Expense)
-    FI Percent = Net / (25 * -Expense)
+    FI Amount = FI_MULTIPLIER * -Expense
+    FI Shortfall = (FI_MULTIPLIER * -Expense) - Net
+    FI Percent = Net / (FI_MULTIPLIER * -Expense)
 
     The default SWR (Safe Withdrawl Rate) is 0.04.
 
+    Ratios with a zero denominator are NaN.
+
+    Metrics are computed in `dtype`, `np.float32` halves the memory traffic on long summaries at ~1e-7 relative precision.
+
+    Returns a DataFrame, or if `as_frame` is False a structured array with a field per metric and a record per row.
+
     """
-    # Create mean from month to month yearly estimates
+    # Create mean from month to month yearly estimates, via cumulative sum over cumulative count of non-NaN values
     cols = ['Total Income', 'Realized Income', 'Expense + Loans', 'Expense', 'Taxes', 'Sales Tax']
-    summary[cols] = summary[cols].expanding().mean()
+    values = summary[cols].values
+    with np.errstate(divide='ignore', invalid='ignore'):
+        summary[cols] = np.nancumsum(values, axis=0) / np.cumsum(~np.isnan(values), axis=0)
 
-    # Calculate metrics
-    metrics = pd.DataFrame({
-        'Debt Ratio [%]' : 100.0 * -summary['Debts'] / summary['Assets'],
-        'Debt to Income [%]' : 100.0 * -summary['Debts'] / summary['Realized Income'],
-        'Debt Utilization [%]' : 100.0 * -summary['Debts'] / summary['Credit Line'],
+    # Pull needed columns into one array and bind them and shared subexpressions once
+    assets, debts, net, total_income, realized, expense, taxes, credit_line, sales_tax = summary[[
+        'Assets', 'Debts', 'Net', 'Total Income', 'Realized Income', 'Expense', 'Taxes', 'Credit Line', 'Sales Tax'
+    ]].values.astype(dtype).T
+    neg_debts = -debts
+    neg_expense = -expense
 
-        'Income Net Multiple [Yr]' : summary['Net'] / summary['Realized Income'],
-        'Expense Net Multiple [Yr]' :  summary['Net'] / -summary['Expense'],
+    # Calculate metrics into one array, a row per label in `_METRIC_LABELS`, zero denominators give NaN
+    metrics = np.empty((len(_METRIC_LABELS), len(net)), dtype=dtype)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Divide once per shared base, then multiply by the reciprocals
+        inv_realized, inv_net, inv_expense = _divide(1.0, np.stack([realized, net, neg_expense]))
 
-        'Profit Margin [%]' : 100.0 * (summary['Realized Income'] + summary['Expense']) / summary['Realized Income'],
+        metrics[0] = _divide(100.0 * neg_debts, assets)
+        metrics[1] = 100.0 * neg_debts * inv_realized
+        metrics[2] = _divide(100.0 * neg_debts, credit_line)
 
-        'SWR Expense Covered [%]' : 100.0 * (swr * summary['Net']) / -summary['Expense'],
-        'SWR Income Covered [%]' : 100.0 * (swr * summary['Net']) / summary['Realized Income'],
+        metrics[3] = net * inv_realized
+        metrics[4] = net * inv_expense
 
-        'Realized Income to Net [%]' : 100.0 * summary['Realized Income'] / summary['Net'],
+        metrics[5] = 100.0 * (realized + expense) * inv_realized
 
-        'Total Income Tax Rate [%]' : -100.0 * summary['Taxes'] / summary['Total Income'],
-        'Realized Income Tax Rate [%]' : -100.0 * summary['Taxes'] / summary['Realized Income'],
-        'Income Tax to Net [%]' : -100.0 * summary['Taxes'] / summary['Net'],
-        'Income Tax to Expense [%]' : -100.0 * summary['Taxes'] / -summary['Expense'],
+        metrics[6] = 100.0 * (swr * net) * inv_expense
+        metrics[7] = 100.0 * (swr * net) * inv_realized
 
-        'Total Sales Tax Rate [%]' : -100.0 * summary['Sales Tax'] / summary['Total Income'],
-        'Realized Sales Tax Rate [%]' : -100.0 * summary['Sales Tax'] / summary['Realized Income'],
-        'Sales Tax to Net [%]' : -100.0 * summary['Sales Tax'] / summary['Net'],
-        'Sales Tax to Expense [%]' : -100.0 * summary['Sales Tax'] / -summary['Expense'],
+        metrics[8] = 100.0 * realized * inv_net
 
-        'Total Tax Rate [%]'          : -100.0 * (summary['Taxes'] + summary['Sales Tax']) / summary['Total Income'],
-        'Realized Total Tax Rate [%]' : -100.0 * (summary['Taxes'] + summary['Sales Tax']) / summary['Realized Income'],
-        'Total Tax to Net [%]'        : -100.0 * (summary['Taxes'] + summary['Sales Tax']) / summary['Net'],
-        'Total Tax to Expense [%]'    : -100.0 * (summary['Taxes'] + summary['Sales Tax']) / -summary['Expense'],
-
-        'FI Amount [$]' : 25.0 * -summary['Expense'],
-        'FI Shortfall [$]' : (25.0 * -summary['Expense']) - summary['Net'],
-        'FI Percent [%]' : 100.0 * summary['Net'] / (25.0 * -summary['Expense'])
-    })
+    # Calculate tax and FI ratios
+    _tax_ratios(taxes, sales_tax, total_income, realized, net, expense, out=metrics[9:])
 
-    return metrics
+    return _metric_output(metrics, summary.index, as_frame)
@@ -27,6 +27,9 @@ import re
 DAYS_IN_YEAR = 365.24
 DATE_RE = re.compile(r'\d{4}-\d{2}-\d{2}')
 
+# Finance Constants
+FI_MULTIPLIER = 25.0  # Years of expenses needed for financial independence, inverse of the 4% rule
+
 # Regex Constants
 
 